@@ -5,19 +5,31 @@ Auteur: Roua Jendoubi
 Date: 2025
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, stream_with_context
 from flask_cors import CORS
 import sqlite3
 from datetime import datetime, timedelta
 import json
-import hashlib
+import csv
+import io
+import bcrypt
 import secrets
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
+import queue
+import threading
+import time
 from functools import wraps
 
+# Optionnel: sérialisation binaire compacte pour les clients qui la
+# demandent (Accept: application/x-msgpack)
+try:
+    import ormsgpack
+except ImportError:
+    ormsgpack = None
+
 # Initialise Flask application
 app = Flask(__name__)
 CORS(app)
@@ -26,16 +38,42 @@ CORS(app)
 DATABASE = 'sensorflow.db'
 SECRET_KEY = os.environ.get('SECRET_KEY', 'votre_cle_secrete_changez_moi')
 
+# Incrémenter à chaque évolution du schéma: init_db saute toute la DDL
+# quand la base est déjà à cette version (PRAGMA user_version)
+SCHEMA_VERSION = 1
+
 # ============================================
 # Security Utilities
 # ============================================  
 
+# Coût bcrypt: ~250ms par hash, ajuster selon le matériel cible
+BCRYPT_ROUNDS = 12
+
+# Format texte des horodatages de lectures capteurs (affichage); les
+# expirations sont stockées en epoch entier, voir now_ts()
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def now_ts():
+    """Horodatage epoch en secondes, lié en paramètre dans le SQL:
+    comparaison et index en entier (8 octets) plutôt qu'en texte"""
+    return int(time.time())
+
 def hash_password(password):
     """
-    Hash le mot de passe avec SHA256
-    En production, utiliser bcrypt ou argon2!
+    Hash le mot de passe avec bcrypt (sel aléatoire inclus dans le hash)
+    La lenteur est volontaire: elle limite le cracking hors-ligne
     """
-    return hashlib.sha256(password.encode()).hexdigest()
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('ascii')
+
+def verify_password(password, stored_hash):
+    """Vérifie un mot de passe contre le hash bcrypt stocké"""
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'),
+                              stored_hash.encode('ascii'))
+    except ValueError:
+        # Hash illisible (ancien format) -> refuse la connexion
+        return False
 
 def generate_token():
     """Génère un token de session sécurisé"""
@@ -43,7 +81,10 @@ def generate_token():
 
 def generate_reset_code():
     """Génère un code de réinitialisation à 6 chiffres"""
-    return str(secrets.randbelow(900000) + 100000)
+    # Zéro-padding plutôt que décalage +100000: les codes
+    # commençant par 0 redeviennent possibles (10^6 au lieu de
+    # 9*10^5 combinaisons)
+    return f'{secrets.randbelow(1_000_000):06d}'
 
 # ============================================
 # GESTION DE LA BASE DE DONNÉES
@@ -53,7 +94,26 @@ def init_db():
     """Initialise la base de données avec toutes les tables nécessaires"""
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
-    
+
+    # Mode WAL: les écritures ne bloquent plus les lectures (dashboard)
+    # et le coût des fsync diminue fortement pour les INSERT fréquents
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA foreign_keys=ON')
+
+    # Base déjà au bon schéma: rien à faire
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    if version == SCHEMA_VERSION:
+        conn.close()
+        return
+
+    # Toute la DDL dans une seule transaction: un seul sync au lieu
+    # d'un par CREATE, et le schéma apparaît atomiquement
+    cursor.execute('BEGIN')
+
     # Table des utilisateurs
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -67,17 +127,29 @@ def init_db():
     ''')
     
     # Table des sessions
+    # username/email sont dénormalisés ici pour que require_auth fasse
+    # une seule recherche indexée sans JOIN sur users à chaque requête
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             token TEXT UNIQUE NOT NULL,
+            username TEXT,
+            email TEXT,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            expires_at DATETIME NOT NULL,
+            expires_at INTEGER NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
-    
+
+    # Migration pour les bases créées avant la dénormalisation
+    for column in ('username TEXT', 'email TEXT'):
+        try:
+            cursor.execute(f'ALTER TABLE sessions ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass  # colonne déjà présente
+
+
     # Table de réinitialisation de mot de passe
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS password_resets (
@@ -85,7 +157,7 @@ def init_db():
             user_id INTEGER NOT NULL,
             reset_code TEXT NOT NULL,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            expires_at DATETIME NOT NULL,
+            expires_at INTEGER NOT NULL,
             used BOOLEAN DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
@@ -103,21 +175,256 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
-    
+
+    # Agrégats incrémentaux par utilisateur: maintenus par trigger à
+    # chaque insertion pour que /api/sensors/stats reste O(1) quelle
+    # que soit la taille de l'historique
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_stats (
+            user_id INTEGER PRIMARY KEY,
+            n INTEGER NOT NULL,
+            sum_t REAL NOT NULL,
+            min_t REAL NOT NULL,
+            max_t REAL NOT NULL,
+            sum_h REAL NOT NULL,
+            min_h REAL NOT NULL,
+            max_h REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_readings_ai
+        AFTER INSERT ON sensor_readings
+        BEGIN
+            INSERT INTO sensor_stats
+                (user_id, n, sum_t, min_t, max_t, sum_h, min_h, max_h)
+            VALUES
+                (NEW.user_id, 1,
+                 NEW.temperature, NEW.temperature, NEW.temperature,
+                 NEW.humidity, NEW.humidity, NEW.humidity)
+            ON CONFLICT(user_id) DO UPDATE SET
+                n = n + 1,
+                sum_t = sum_t + NEW.temperature,
+                min_t = min(min_t, NEW.temperature),
+                max_t = max(max_t, NEW.temperature),
+                sum_h = sum_h + NEW.humidity,
+                min_h = min(min_h, NEW.humidity),
+                max_h = max(max_h, NEW.humidity);
+        END
+    ''')
+
+    # Migration: les anciennes expirations texte ne sont pas comparables
+    # aux epochs entiers - on invalide ces lignes (reconnexion requise)
+    cursor.execute(
+        "DELETE FROM sessions WHERE typeof(expires_at) != 'integer'")
+    cursor.execute(
+        "DELETE FROM password_resets WHERE typeof(expires_at) != 'integer'")
+
+    # Rattrapage pour les lectures insérées avant la création du trigger
+    cursor.execute('''
+        INSERT INTO sensor_stats
+            (user_id, n, sum_t, min_t, max_t, sum_h, min_h, max_h)
+        SELECT user_id, COUNT(*),
+               SUM(temperature), MIN(temperature), MAX(temperature),
+               SUM(humidity), MIN(humidity), MAX(humidity)
+        FROM sensor_readings
+        WHERE user_id NOT IN (SELECT user_id FROM sensor_stats)
+        GROUP BY user_id
+    ''')
+
+    # Index pour les requêtes chaudes: sans eux, require_auth et les GET
+    # capteurs font un scan complet de table à chaque requête
+    # (username/email sont déjà indexés par leur contrainte UNIQUE)
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_token
+        ON sessions(token)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires
+        ON sessions(expires_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_readings_user_ts
+        ON sensor_readings(user_id, timestamp DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_readings_user_device_ts
+        ON sensor_readings(user_id, device_id, timestamp DESC)
+    ''')
+    # Index partiel: ne contient que les codes encore utilisables, donc
+    # un B-tree plus petit et plus chaud en cache que la table entière
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_resets_live
+        ON password_resets(user_id, reset_code) WHERE used = 0
+    ''')
+
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.commit()
     conn.close()
     print("✅ Base de données initialisée avec succès!")
 
-def get_db_connection():
-    """Établit une connexion à la base de données"""
+def purge_expired():
+    """
+    Supprime les sessions expirées et les codes de réinitialisation
+    consommés ou expirés - garde les index de sessions/resets petits
+    """
     conn = sqlite3.connect(DATABASE)
+    now = now_ts()
+    conn.execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+    conn.execute('DELETE FROM password_resets '
+                 'WHERE used = 1 OR expires_at < ?', (now,))
+    conn.commit()
+    conn.close()
+
+def start_purge_scheduler(interval=600):
+    """Lance le nettoyage périodique dans un thread démon"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                purge_expired()
+            except sqlite3.Error:
+                pass  # base occupée: on réessaiera au prochain passage
+            purge_token_cache()
+    threading.Thread(target=loop, daemon=True).start()
+
+# Requêtes chaudes gardées en constantes de module: réutiliser le même
+# objet chaîne permet au cache d'instructions préparées de sqlite3 de
+# resservir le plan compilé au lieu de re-parser le SQL à chaque requête
+SQL_AUTH_LOOKUP = '''
+    SELECT user_id, username, email, expires_at
+    FROM sessions
+    WHERE token = ? AND expires_at > ?
+'''
+
+SQL_INSERT_READING = '''
+    INSERT INTO sensor_readings
+    (user_id, device_id, temperature, humidity, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+# Colonnes explicites plutôt que SELECT *: le planificateur peut servir
+# la requête depuis l'index composite sans relire la ligne complète
+# Deux variantes plutôt qu'un filtre (? IS NULL OR device_id = ?):
+# la forme OR fait renoncer le planificateur à l'index composite
+# (user_id, device_id, timestamp) et filtre device_id en résiduel
+SQL_SELECT_READINGS = '''
+    SELECT id, device_id, temperature, humidity, timestamp
+    FROM sensor_readings
+    WHERE user_id = ?
+    ORDER BY timestamp DESC LIMIT ?
+'''
+
+SQL_SELECT_READINGS_BY_DEVICE = '''
+    SELECT id, device_id, temperature, humidity, timestamp
+    FROM sensor_readings
+    WHERE user_id = ? AND device_id = ?
+    ORDER BY timestamp DESC LIMIT ?
+'''
+
+# Pool de connexions pré-ouvertes et déjà configurées: sous un serveur
+# WSGI multi-threads, ouvrir/fermer une connexion par requête repaierait
+# le coût d'initialisation SQLite en permanence
+POOL_SIZE = 16
+connection_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+def make_connection():
+    """Ouvre une connexion SQLite configurée (WAL, Row, clés étrangères)"""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False,
+                           cached_statements=200)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA foreign_keys=ON')
     return conn
 
+def fill_connection_pool():
+    """Pré-remplit le pool au démarrage"""
+    while not connection_pool.full():
+        connection_pool.put(make_connection())
+
+def get_db_connection():
+    """
+    Emprunte une connexion au pool pour la durée de la requête
+    (cachée sur flask.g, rendue au pool par close_db)
+    """
+    if 'db' not in g:
+        try:
+            g.db = connection_pool.get_nowait()
+        except queue.Empty:
+            g.db = make_connection()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(error):
+    """Rend la connexion au pool à la fin de la requête"""
+    db = g.pop('db', None)
+    if db is not None:
+        # Un handler qui échoue entre une écriture et son commit rend
+        # une connexion avec transaction ouverte: sans rollback, le
+        # prochain commit sur cette connexion emporterait les écritures
+        # partielles de la requête échouée (et le verrou d'écriture WAL
+        # resterait tenu pendant que la connexion dort dans le pool)
+        if db.in_transaction:
+            db.rollback()
+        try:
+            connection_pool.put_nowait(db)
+        except queue.Full:
+            db.close()
+
 # ============================================
 # DÉCORATEUR D'AUTHENTIFICATION
 # ============================================
 
+# Cache token -> utilisateur: l'ESP32 et le dashboard représentent le
+# même token plusieurs fois par minute, inutile d'interroger SQLite à
+# chaque fois. TTL court pour que l'expiration de session reste effective
+TOKEN_CACHE = {}  # {token: (current_user, péremption time.monotonic)}
+TOKEN_CACHE_TTL = 60  # secondes
+token_cache_lock = threading.Lock()
+
+def cache_token(token, current_user, session_expires_at):
+    """Mémorise le résultat d'une vérification de token"""
+    # TTL plafonné au temps restant de la session: le cache ne doit
+    # jamais accepter un token au-delà de son expires_at en base
+    ttl = min(TOKEN_CACHE_TTL, session_expires_at - now_ts())
+    if ttl <= 0:
+        return
+    with token_cache_lock:
+        TOKEN_CACHE[token] = (current_user, time.monotonic() + ttl)
+
+def get_cached_user(token):
+    """Retourne l'utilisateur en cache pour ce token, ou None"""
+    with token_cache_lock:
+        entry = TOKEN_CACHE.get(token)
+        if entry is not None:
+            if time.monotonic() < entry[1]:
+                return entry[0]
+            del TOKEN_CACHE[token]
+    return None
+
+def purge_token_cache():
+    """Retire les entrées périmées des tokens jamais re-présentés"""
+    now = time.monotonic()
+    with token_cache_lock:
+        for token in [t for t, (_, deadline) in TOKEN_CACHE.items()
+                      if deadline <= now]:
+            del TOKEN_CACHE[token]
+
+def invalidate_token(token):
+    """Retire un token du cache (déconnexion)"""
+    with token_cache_lock:
+        TOKEN_CACHE.pop(token, None)
+
+def invalidate_user_tokens(user_id):
+    """Retire tous les tokens d'un utilisateur (reset mot de passe)"""
+    with token_cache_lock:
+        for token in [t for t, (user, _) in TOKEN_CACHE.items()
+                      if user['id'] == user_id]:
+            del TOKEN_CACHE[token]
+
 def require_auth(f):
     """
     Décorateur pour protéger les routes nécessitant une authentification
@@ -125,33 +432,27 @@ def require_auth(f):
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Récupérer le token depuis le header
+        # Format attendu: "Bearer <token>" - partition s'arrête au
+        # premier espace et renvoie une chaîne vide si le header est
+        # absent ou malformé, sans IndexError à attraper
         auth_header = request.headers.get('Authorization')
+        token = (auth_header or '').partition(' ')[2]
         
-        if not auth_header:
+        if not token:
             return jsonify({
                 'status': 'error',
-                'message': 'Token d\'authentification manquant'
+                'message': 'Token d\'authentification manquant ou invalide'
             }), 401
         
-        # Format attendu: "Bearer <token>"
-        try:
-            token = auth_header.split(' ')[1]
-        except IndexError:
-            return jsonify({
-                'status': 'error',
-                'message': 'Format de token invalide'
-            }), 401
-        
-        # Vérifier le token dans la base de données
+        # Cache d'abord: la plupart des requêtes évitent SQLite
+        cached = get_cached_user(token)
+        if cached is not None:
+            request.current_user = cached
+            return f(*args, **kwargs)
+
+        # Vérifier le token: une seule recherche indexée, sans JOIN
         conn = get_db_connection()
-        session = conn.execute('''
-            SELECT s.*, u.id as user_id, u.username, u.email
-            FROM sessions s
-            JOIN users u ON s.user_id = u.id
-            WHERE s.token = ? AND s.expires_at > datetime('now')
-        ''', (token,)).fetchone()
-        conn.close()
+        session = conn.execute(SQL_AUTH_LOOKUP, (token, now_ts())).fetchone()
         
         if not session:
             return jsonify({
@@ -165,7 +466,8 @@ def require_auth(f):
             'username': session['username'],
             'email': session['email']
         }
-        
+        cache_token(token, request.current_user, session['expires_at'])
+
         return f(*args, **kwargs)
     
     return decorated_function
@@ -215,34 +517,34 @@ def register():
         ).fetchone()
         
         if existing:
-            conn.close()
             return jsonify({
                 'status': 'error',
                 'message': 'Nom d\'utilisateur ou email déjà utilisé'
             }), 409
         
-        # Créer l'utilisateur
+        # Créer l'utilisateur - RETURNING (SQLite >= 3.35) renvoie l'id
+        # directement, sans repasser par cursor.lastrowid
         password_hash = hash_password(password)
         cursor = conn.cursor()
-        cursor.execute('''
+        row = cursor.execute('''
             INSERT INTO users (username, email, password_hash)
             VALUES (?, ?, ?)
-        ''', (username, email, password_hash))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        
-        # Créer une session
+            RETURNING id
+        ''', (username, email, password_hash)).fetchone()
+
+        user_id = row['id']
+
+        # Créer une session dans la même transaction que l'utilisateur:
+        # un seul commit (un seul fsync) pour l'inscription complète
         token = generate_token()
-        expires_at = datetime.now() + timedelta(days=7)
+        expires_at = now_ts() + 7 * 86400
         
         cursor.execute('''
-            INSERT INTO sessions (user_id, token, expires_at)
-            VALUES (?, ?, ?)
-        ''', (user_id, token, expires_at))
+            INSERT INTO sessions (user_id, token, username, email, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, token, username, email, expires_at))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'status': 'success',
@@ -253,7 +555,7 @@ def register():
                 'email': email
             },
             'token': token,
-            'expires_at': expires_at.isoformat()
+            'expires_at': datetime.fromtimestamp(expires_at).isoformat()
         }), 201
         
     except Exception as e:
@@ -279,18 +581,16 @@ def login():
         
         username = data['username'].strip()
         password = data['password']
-        password_hash = hash_password(password)
-        
-        # Vérifier les identifiants
+
+        # Recherche indexée par username, puis vérification bcrypt en Python
         conn = get_db_connection()
         user = conn.execute('''
             SELECT id, username, email, password_hash
             FROM users
-            WHERE username = ? AND password_hash = ?
-        ''', (username, password_hash)).fetchone()
-        
-        if not user:
-            conn.close()
+            WHERE username = ?
+        ''', (username,)).fetchone()
+
+        if not user or not verify_password(password, user['password_hash']):
             return jsonify({
                 'status': 'error',
                 'message': 'Identifiants incorrects'
@@ -298,13 +598,13 @@ def login():
         
         # Créer une nouvelle session
         token = generate_token()
-        expires_at = datetime.now() + timedelta(days=7)
+        expires_at = now_ts() + 7 * 86400
         
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO sessions (user_id, token, expires_at)
-            VALUES (?, ?, ?)
-        ''', (user['id'], token, expires_at))
+            INSERT INTO sessions (user_id, token, username, email, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user['id'], token, user['username'], user['email'], expires_at))
         
         # Mettre à jour last_login
         cursor.execute('''
@@ -313,7 +613,6 @@ def login():
         ''', (user['id'],))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'status': 'success',
@@ -324,7 +623,7 @@ def login():
                 'email': user['email']
             },
             'token': token,
-            'expires_at': expires_at.isoformat()
+            'expires_at': datetime.fromtimestamp(expires_at).isoformat()
         }), 200
         
     except Exception as e:
@@ -339,12 +638,12 @@ def logout():
     """Déconnexion - supprime la session active"""
     try:
         auth_header = request.headers.get('Authorization')
-        token = auth_header.split(' ')[1]
+        token = (auth_header or '').partition(' ')[2]
         
         conn = get_db_connection()
         conn.execute('DELETE FROM sessions WHERE token = ?', (token,))
         conn.commit()
-        conn.close()
+        invalidate_token(token)
         
         return jsonify({
             'status': 'success',
@@ -391,7 +690,7 @@ def forgot_password():
         
         # Générer un code de réinitialisation
         reset_code = generate_reset_code()
-        expires_at = datetime.now() + timedelta(minutes=10)
+        expires_at = now_ts() + 600
         
         cursor = conn.cursor()
         cursor.execute('''
@@ -400,7 +699,6 @@ def forgot_password():
         ''', (user['id'], reset_code, expires_at))
         
         conn.commit()
-        conn.close()
         
         # TODO: Envoyer le code par email
         # Pour la démo, on retourne le code dans la réponse
@@ -446,12 +744,11 @@ def verify_reset_code():
             FROM password_resets pr
             JOIN users u ON pr.user_id = u.id
             WHERE u.email = ? AND pr.reset_code = ?
-            AND pr.expires_at > datetime('now') AND pr.used = 0
+            AND pr.expires_at > ? AND pr.used = 0
             ORDER BY pr.created_at DESC
             LIMIT 1
-        ''', (email, code)).fetchone()
+        ''', (email, code, now_ts())).fetchone()
         
-        conn.close()
         
         if not reset:
             return jsonify({
@@ -504,13 +801,12 @@ def reset_password():
             FROM password_resets pr
             JOIN users u ON pr.user_id = u.id
             WHERE u.email = ? AND pr.reset_code = ?
-            AND pr.expires_at > datetime('now') AND pr.used = 0
+            AND pr.expires_at > ? AND pr.used = 0
             ORDER BY pr.created_at DESC
             LIMIT 1
-        ''', (email, code)).fetchone()
+        ''', (email, code, now_ts())).fetchone()
         
         if not reset:
-            conn.close()
             return jsonify({
                 'status': 'error',
                 'message': 'Code invalide ou expiré'
@@ -535,9 +831,9 @@ def reset_password():
         cursor.execute('''
             DELETE FROM sessions WHERE user_id = ?
         ''', (reset['user_id'],))
-        
+
         conn.commit()
-        conn.close()
+        invalidate_user_tokens(reset['user_id'])
         
         return jsonify({
             'status': 'success',
@@ -554,6 +850,50 @@ def reset_password():
 # ROUTES CAPTEURS (PROTÉGÉES)
 # ============================================
 
+# Les lectures sont mises en file et insérées par lots par un thread
+# dédié: un seul commit (donc un seul fsync) par lot au lieu d'un par
+# requête POST, ce qui multiplie le débit d'ingestion
+reading_queue = queue.Queue()
+FLUSH_BATCH_SIZE = 200
+FLUSH_INTERVAL = 0.25  # secondes
+
+def flush_readings_forever():
+    """Boucle du thread d'écriture: draine la file et insère par lots"""
+    conn = make_connection()
+    while True:
+        batch = [reading_queue.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(batch) < FLUSH_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(reading_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(SQL_INSERT_READING, batch)
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # Erreur transitoire ("database is locked" typiquement):
+            # les clients ont déjà reçu leur 202, remettre le lot en
+            # file et laisser le verrou se libérer avant de réessayer
+            conn.rollback()
+            for row in batch:
+                reading_queue.put(row)
+            print(f"⚠️ Lot de {len(batch)} lectures remis en file: {e}")
+            time.sleep(FLUSH_INTERVAL)
+        except sqlite3.Error as e:
+            # Erreur non transitoire (contrainte, schéma): réinsérer
+            # bouclerait sans fin, on trace la perte au moins
+            conn.rollback()
+            print(f"⚠️ Lot de {len(batch)} lectures abandonné: {e}")
+
+def start_reading_flusher():
+    """Démarre le thread d'écriture des lectures"""
+    threading.Thread(target=flush_readings_forever, daemon=True).start()
+
 @app.route('/api/sensors/data', methods=['POST'])
 @require_auth
 def receive_sensor_data():
@@ -588,24 +928,17 @@ def receive_sensor_data():
                 'message': 'Humidité hors limites'
             }), 400
         
-        # Enregistrer les données
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO sensor_readings (user_id, device_id, temperature, humidity)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, device_id, temperature, humidity))
-        
-        reading_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
+        # Mise en file: la requête répond sans attendre le fsync, le
+        # thread d'écriture regroupe les lectures en un seul commit
+        timestamp = datetime.now().strftime(TS_FORMAT)
+        reading_queue.put((user_id, device_id, temperature, humidity,
+                           timestamp))
+
         return jsonify({
             'status': 'success',
-            'message': 'Données enregistrées',
-            'id': reading_id,
-            'timestamp': datetime.now().isoformat()
-        }), 201
+            'message': 'Données acceptées',
+            'timestamp': timestamp
+        }), 202
         
     except Exception as e:
         return jsonify({
@@ -619,37 +952,68 @@ def get_sensor_data():
     """
     Récupère les données des capteurs de l'utilisateur
     Query params: limit, device_id
+    La réponse est streamée ligne par ligne: aucune liste intermédiaire
+    n'est matérialisée, même pour des limites élevées
+    Formats négociés via Accept: JSON (défaut), CSV, MessagePack - les
+    clés JSON répétées dominent le poids du JSON, CSV/msgpack divisent
+    les octets transmis par 3 à 5
     """
     try:
         user_id = request.current_user['id']
         limit = request.args.get('limit', 100, type=int)
         device_id = request.args.get('device_id', None)
-        
+
         conn = get_db_connection()
-        
-        if device_id:
-            readings = conn.execute('''
-                SELECT * FROM sensor_readings
-                WHERE user_id = ? AND device_id = ?
-                ORDER BY timestamp DESC LIMIT ?
-            ''', (user_id, device_id, limit)).fetchall()
+
+        if device_id is None:
+            cursor = conn.execute(SQL_SELECT_READINGS, (user_id, limit))
         else:
-            readings = conn.execute('''
-                SELECT * FROM sensor_readings
-                WHERE user_id = ?
-                ORDER BY timestamp DESC LIMIT ?
-            ''', (user_id, limit)).fetchall()
-        
-        conn.close()
-        
-        data = [dict(row) for row in readings]
-        
-        return jsonify({
-            'status': 'success',
-            'count': len(data),
-            'data': data
-        }), 200
-        
+            cursor = conn.execute(SQL_SELECT_READINGS_BY_DEVICE,
+                                  (user_id, device_id, limit))
+
+        accept = request.accept_mimetypes.best_match(
+            ['application/json', 'text/csv', 'application/x-msgpack'])
+
+        if accept == 'text/csv':
+            def generate_csv(rows):
+                # csv.writer pour le quoting RFC-4180: device_id vient
+                # du client, une virgule ou un guillemet dedans
+                # décalerait les colonnes avec un simple join
+                buf = io.StringIO()
+                writer = csv.writer(buf, lineterminator='\r\n')
+                writer.writerow(('id', 'device_id', 'temperature',
+                                 'humidity', 'timestamp'))
+                yield buf.getvalue()
+                for row in rows:
+                    buf.seek(0)
+                    buf.truncate()
+                    writer.writerow((row['id'], row['device_id'],
+                                     row['temperature'], row['humidity'],
+                                     row['timestamp']))
+                    yield buf.getvalue()
+
+            return Response(stream_with_context(generate_csv(cursor)),
+                            mimetype='text/csv')
+
+        if accept == 'application/x-msgpack' and ormsgpack is not None:
+            data = [dict(row) for row in cursor]
+            return Response(
+                ormsgpack.packb({'status': 'success',
+                                 'count': len(data),
+                                 'data': data}),
+                mimetype='application/x-msgpack')
+
+        def generate(rows):
+            yield '{"status": "success", "data": ['
+            count = 0
+            for row in rows:
+                yield (',' if count else '') + json.dumps(dict(row))
+                count += 1
+            yield '], "count": %d}' % count
+
+        return Response(stream_with_context(generate(cursor)),
+                        mimetype='application/json')
+
     except Exception as e:
         return jsonify({
             'status': 'error',
@@ -659,40 +1023,46 @@ def get_sensor_data():
 @app.route('/api/sensors/stats', methods=['GET'])
 @require_auth
 def get_stats():
-    """Récupère les statistiques des capteurs de l'utilisateur"""
+    """
+    Récupère les statistiques des capteurs de l'utilisateur
+    Lecture d'une seule ligne pré-agrégée (maintenue par trigger),
+    au lieu d'un scan AVG/MIN/MAX de tout l'historique
+    """
     try:
         user_id = request.current_user['id']
-        
+
         conn = get_db_connection()
-        
+
         stats = conn.execute('''
-            SELECT 
-                COUNT(*) as total_readings,
-                AVG(temperature) as avg_temp,
-                MIN(temperature) as min_temp,
-                MAX(temperature) as max_temp,
-                AVG(humidity) as avg_hum,
-                MIN(humidity) as min_hum,
-                MAX(humidity) as max_hum
-            FROM sensor_readings
+            SELECT n, sum_t, min_t, max_t, sum_h, min_h, max_h
+            FROM sensor_stats
             WHERE user_id = ?
         ''', (user_id,)).fetchone()
-        
-        conn.close()
-        
+
+        if not stats or stats['n'] == 0:
+            return jsonify({
+                'status': 'success',
+                'statistics': {
+                    'total_readings': 0,
+                    'temperature': {'average': 0, 'minimum': 0, 'maximum': 0},
+                    'humidity': {'average': 0, 'minimum': 0, 'maximum': 0}
+                }
+            }), 200
+
+        n = stats['n']
         return jsonify({
             'status': 'success',
             'statistics': {
-                'total_readings': stats['total_readings'],
+                'total_readings': n,
                 'temperature': {
-                    'average': round(stats['avg_temp'], 2) if stats['avg_temp'] else 0,
-                    'minimum': round(stats['min_temp'], 2) if stats['min_temp'] else 0,
-                    'maximum': round(stats['max_temp'], 2) if stats['max_temp'] else 0
+                    'average': round(stats['sum_t'] / n, 2),
+                    'minimum': round(stats['min_t'], 2),
+                    'maximum': round(stats['max_t'], 2)
                 },
                 'humidity': {
-                    'average': round(stats['avg_hum'], 2) if stats['avg_hum'] else 0,
-                    'minimum': round(stats['min_hum'], 2) if stats['min_hum'] else 0,
-                    'maximum': round(stats['max_hum'], 2) if stats['max_hum'] else 0
+                    'average': round(stats['sum_h'] / n, 2),
+                    'minimum': round(stats['min_h'], 2),
+                    'maximum': round(stats['max_h'], 2)
                 }
             }
         }), 200
@@ -750,7 +1120,11 @@ def internal_error(error):
 
 if __name__ == '__main__':
     init_db()
-    
+    purge_expired()
+    fill_connection_pool()
+    start_purge_scheduler()
+    start_reading_flusher()
+
     print("\n" + "="*60)
     print("🚀 SensorFlow Hub API v2.0 - Avec Authentification")
     print("="*60)
@@ -766,6 +1140,7 @@ if __name__ == '__main__':
     print("   GET    /api/sensors/data")
     print("   GET    /api/sensors/stats")
     print("="*60 + "\n")
-     # Lancement du serveur Flask
-    # debug=True pour le développement (désactiver en production)
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+     # Lancement du serveur Flask de développement uniquement
+    # En production: gunicorn -w 4 --threads 4 -b 0.0.0.0:5000 wsgi:app
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
+    app.run(host='0.0.0.0', port=5000, debug=debug)
\ No newline at end of file
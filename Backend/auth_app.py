@@ -5,34 +5,138 @@ Auteur: Roua Jendoubi
 Date: 2025
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from datetime import datetime, timedelta
-import hashlib
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from datetime import datetime
+import heapq
+import hmac
+import itertools
+import math
+import os
 import secrets
-from collections import defaultdict
+import threading
+import time
+from collections import defaultdict, deque
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
+
+# Optionnel: encodeur JSON en C, nettement plus rapide que le module
+# json standard (surtout pour les flottants des lectures capteurs)
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Initialisation de l'application Flask
 app = Flask(__name__)
 CORS(app)
 
+if orjson is not None:
+    from flask.json.provider import JSONProvider
+
+    class OrjsonProvider(JSONProvider):
+        """Branche orjson derrière jsonify, sans changer les handlers"""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS
+                                ).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+
+# Limites par IP sur les routes d'authentification: chaque tentative
+# coûte ~250ms de CPU (Argon2), sans limite un simple flood suffit à
+# saturer le serveur. Réponse 429 automatique au-delà du quota
+# (stockage mémoire: passer à redis:// en multi-workers)
+limiter = Limiter(get_remote_address, app=app, storage_uri='memory://')
+
 # ============================================
 # STOCKAGE EN MÉMOIRE
 # ============================================
 
 # Dictionnaires pour stocker les données en mémoire
 users_db = {}  # {username: {email, password_hash, created_at}}
-sessions_db = {}  # {token: {username, expires_at}}
-reset_codes_db = {}  # {email: {code, expires_at}}
-sensor_data_db = defaultdict(list)  # {username: [readings]}
+sessions_db = {}  # {token: {username, expires_at (epoch)}}
+reset_codes_db = {}  # {email: {code, expires_at (epoch)}}
+# Tampon borné par utilisateur: deque(maxlen) évince le plus ancien en
+# O(1) à l'append, sans la recopie de liste qu'imposait un slice [-100:]
+MAX_READINGS = 100
+sensor_data_db = defaultdict(lambda: deque(maxlen=MAX_READINGS))
+
+# Agrégats courants (somme/min/max) alignés sur le contenu du tampon:
+# mis à jour à chaque insertion pour que get_stats lise en O(1) au lieu
+# de reparcourir les 100 lectures à chaque appel
+def _empty_stats():
+    return {'n': 0,
+            't_sum': 0.0, 't_min': math.inf, 't_max': -math.inf,
+            'h_sum': 0.0, 'h_min': math.inf, 'h_max': -math.inf}
+
+sensor_stats = defaultdict(_empty_stats)
+
+# Compteur d'ids par utilisateur: len(tampon) + 1 produisait des ids
+# dupliqués dès que la deque atteignait sa capacité (toujours 101)
+reading_counters = defaultdict(lambda: itertools.count(1))
+
+# Verrou du chemin capteurs: éviction + mise à jour des agrégats est
+# une séquence lire-modifier-écrire; deux POST concurrents du même
+# utilisateur pourraient soustraire deux fois la même lecture évincée
+# et fausser les sommes pour de bon (même traitement que sessions_lock)
+sensor_lock = threading.Lock()
+
+# Index secondaire email -> username: recherche en O(1) au lieu de
+# parcourir tous les utilisateurs à chaque inscription / mot de passe
+# oublié. Protégé par un verrou car les serveurs multi-threads peuvent
+# inscrire deux utilisateurs en même temps
+email_to_username = {}
+users_lock = threading.Lock()
+
+# Index inverse username -> tokens actifs: invalider les sessions d'un
+# utilisateur (reset mot de passe) sans parcourir tout sessions_db
+user_sessions = defaultdict(set)
+
+# Tas (expires_at epoch, token) des sessions, trié par expiration: permet de
+# purger les sessions périmées en O(log n) au lieu de laisser
+# sessions_db grossir indéfiniment dans un processus longue durée
+session_expiry_heap = []
+
+# Verrou d'écriture sur l'état des sessions: sessions_db, user_sessions
+# et le tas doivent évoluer ensemble quand plusieurs threads gunicorn
+# créent/détruisent des sessions en parallèle. Les lectures du chemin
+# chaud (sessions_db.get dans require_auth) restent sans verrou: un
+# accès dict isolé est atomique sous le GIL, et prendre un verrou -
+# même partagé - y coûterait plus cher que la lecture elle-même
+sessions_lock = threading.Lock()
 
 # ============================================
 # UTILITAIRES DE SÉCURITÉ
 # ============================================
 
+# Hasher Argon2id partagé, paramètres OWASP (64MB, t=3, p=2): chaque
+# vérification coûte ~250ms et beaucoup de mémoire, ce qui neutralise
+# le cracking GPU hors-ligne en cas de fuite de users_db
+ph = PasswordHasher(memory_cost=65536, time_cost=3, parallelism=2)
+
+# Hash jetable au démarrage: la toute première invocation paie
+# l'allocation de l'arène mémoire de 64MB, autant que ce ne soit pas
+# le premier utilisateur qui se connecte
+ph.hash('warmup')
+
 def hash_password(password):
-    """Hash le mot de passe avec SHA256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash le mot de passe avec Argon2id (sel géré par la bibliothèque)"""
+    return ph.hash(password)
+
+def verify_password(password, stored_hash):
+    """Vérifie un mot de passe contre le hash Argon2 stocké"""
+    try:
+        ph.verify(stored_hash, password)
+        return True
+    except (VerifyMismatchError, InvalidHashError):
+        # Mauvais mot de passe, ou hash d'un ancien format
+        return False
 
 def generate_token():
     """Génère un token de session sécurisé"""
@@ -40,20 +144,62 @@ def generate_token():
 
 def generate_reset_code():
     """Génère un code de réinitialisation à 6 chiffres"""
-    return str(secrets.randbelow(900000) + 100000)
+    # Zéro-padding plutôt que décalage +100000: les codes
+    # commençant par 0 redeviennent possibles (10^6 au lieu de
+    # 9*10^5 combinaisons)
+    return f'{secrets.randbelow(1_000_000):06d}'
+
+def reap_expired_sessions():
+    """Évacue du dictionnaire les sessions dont l'expiration est passée"""
+    now = time.time()
+    # Coup d'oeil sans verrou d'abord: dans le cas courant rien n'est
+    # périmé et le chemin authentifié ne paie aucun mutex; la condition
+    # est revérifiée sous verrou avant de dépiler
+    if not session_expiry_heap or session_expiry_heap[0][0] > now:
+        return
+    with sessions_lock:
+        while session_expiry_heap and session_expiry_heap[0][0] <= now:
+            _, token = heapq.heappop(session_expiry_heap)
+            session = sessions_db.get(token)
+            if session and session['expires_at'] <= now:
+                del sessions_db[token]
+                user_sessions[session['username']].discard(token)
 
 def verify_token(token):
     """Vérifie si un token est valide"""
-    if token not in sessions_db:
+    reap_expired_sessions()
+    session = sessions_db.get(token)
+    if session is None:
         return None
-    
-    session = sessions_db[token]
-    if datetime.now() > session['expires_at']:
-        del sessions_db[token]
+    if time.time() > session['expires_at']:
+        with sessions_lock:
+            sessions_db.pop(token, None)
+            user_sessions[session['username']].discard(token)
         return None
     
     return session['username']
 
+# Balayage périodique: reap_expired_sessions ne tourne qu'au fil des
+# requêtes, et rien ne purge reset_codes_db en dehors du chemin de
+# vérification. Ce thread borne la mémoire même sans trafic et garde
+# les dictionnaires compacts pour les lookups de require_auth
+SWEEP_INTERVAL = 60
+
+def sweep_expired_forever():
+    """Evince toutes les 60s les sessions et codes de reset périmés"""
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        reap_expired_sessions()
+        now = time.time()
+        for email, reset_data in list(reset_codes_db.items()):
+            if now > reset_data['expires_at']:
+                reset_codes_db.pop(email, None)
+
+def start_sweeper():
+    threading.Thread(target=sweep_expired_forever, daemon=True).start()
+
+start_sweeper()
+
 # ============================================
 # DÉCORATEUR D'AUTHENTIFICATION
 # ============================================
@@ -64,20 +210,16 @@ def require_auth(f):
     
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        # partition s'arrête au premier espace et renvoie une chaîne
+        # vide si le format "Bearer <token>" n'est pas respecté: pas
+        # de liste intermédiaire ni d'IndexError à attraper
         auth_header = request.headers.get('Authorization')
+        token = (auth_header or '').partition(' ')[2]
         
-        if not auth_header:
-            return jsonify({
-                'status': 'error',
-                'message': 'Token d\'authentification manquant'
-            }), 401
-        
-        try:
-            token = auth_header.split(' ')[1]
-        except IndexError:
+        if not token:
             return jsonify({
                 'status': 'error',
-                'message': 'Format de token invalide'
+                'message': 'Token d\'authentification manquant ou invalide'
             }), 401
         
         username = verify_token(token)
@@ -96,335 +238,376 @@ def require_auth(f):
 # ROUTES D'AUTHENTIFICATION
 # ============================================
 
+# Champs requis par route, en frozenset: le test d'inclusion se fait en
+# une opération d'ensembles en C, sans générateur Python par requête
+REGISTER_FIELDS = frozenset(('username', 'email', 'password'))
+LOGIN_FIELDS = frozenset(('username', 'password'))
+VERIFY_CODE_FIELDS = frozenset(('email', 'code'))
+RESET_FIELDS = frozenset(('email', 'code', 'new_password'))
+SENSOR_FIELDS = frozenset(('temperature', 'humidity'))
+
 @app.route('/api/auth/register', methods=['POST'])
+@limiter.limit('10 per hour')
 def register():
     """
     Inscription d'un nouvel utilisateur
     Body: { "username": "...", "email": "...", "password": "..." }
     """
-    try:
-        data = request.get_json()
-        
-        if not all(k in data for k in ['username', 'email', 'password']):
-            return jsonify({
-                'status': 'error',
-                'message': 'Données manquantes'
-            }), 400
-        
-        username = data['username'].strip()
-        email = data['email'].strip().lower()
-        password = data['password']
-        
-        # Validation
-        if len(username) < 3:
-            return jsonify({
-                'status': 'error',
-                'message': 'Nom d\'utilisateur trop court (min 3 caractères)'
-            }), 400
-        
-        if len(password) < 6:
-            return jsonify({
-                'status': 'error',
-                'message': 'Mot de passe trop court (min 6 caractères)'
-            }), 400
-        
-        # Vérifier si l'utilisateur existe déjà
+    data = request.get_json(silent=True) or {}
+
+    if not REGISTER_FIELDS.issubset(data):
+        return jsonify({
+            'status': 'error',
+            'message': 'Données manquantes'
+        }), 400
+
+    username = data['username'].strip()
+    email = data['email'].strip().lower()
+    password = data['password']
+
+    # Validation
+    if len(username) < 3:
+        return jsonify({
+            'status': 'error',
+            'message': 'Nom d\'utilisateur trop court (min 3 caractères)'
+        }), 400
+
+    if len(password) < 6:
+        return jsonify({
+            'status': 'error',
+            'message': 'Mot de passe trop court (min 6 caractères)'
+        }), 400
+
+    # Hash calculé hors verrou (c'est la partie coûteuse)
+    password_hash = hash_password(password)
+
+    # Vérifier l'unicité et créer l'utilisateur atomiquement
+    with users_lock:
         if username in users_db:
             return jsonify({
                 'status': 'error',
                 'message': 'Nom d\'utilisateur déjà utilisé'
             }), 409
-        
-        if any(u['email'] == email for u in users_db.values()):
+
+        if email in email_to_username:
             return jsonify({
                 'status': 'error',
                 'message': 'Email déjà utilisé'
             }), 409
-        
-        # Créer l'utilisateur
-        password_hash = hash_password(password)
+
         users_db[username] = {
             'email': email,
             'password_hash': password_hash,
             'created_at': datetime.now().isoformat()
         }
-        
-        # Créer une session
-        token = generate_token()
+        email_to_username[email] = username
+
+    # Créer une session
+    token = generate_token()
+    expires_at = time.time() + 7 * 86400
+    with sessions_lock:
         sessions_db[token] = {
             'username': username,
-            'expires_at': datetime.now() + timedelta(days=7)
+            'expires_at': expires_at
         }
-        
-        return jsonify({
-            'status': 'success',
-            'message': 'Inscription réussie',
-            'user': {
-                'username': username,
-                'email': email
-            },
-            'token': token
-        }), 201
-        
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+        heapq.heappush(session_expiry_heap, (expires_at, token))
+        user_sessions[username].add(token)
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Inscription réussie',
+        'user': {
+            'username': username,
+            'email': email
+        },
+        'token': token
+    }), 201
 
 @app.route('/api/auth/login', methods=['POST'])
+@limiter.limit('5 per minute')
 def login():
     """
     Connexion d'un utilisateur
     Body: { "username": "...", "password": "..." }
     """
-    try:
-        data = request.get_json()
-        
-        if not all(k in data for k in ['username', 'password']):
-            return jsonify({
-                'status': 'error',
-                'message': 'Identifiants manquants'
-            }), 400
-        
-        username = data['username'].strip()
-        password = data['password']
-        password_hash = hash_password(password)
-        
-        # Vérifier les identifiants
-        if username not in users_db:
-            return jsonify({
-                'status': 'error',
-                'message': 'Identifiants incorrects'
-            }), 401
-        
-        if users_db[username]['password_hash'] != password_hash:
-            return jsonify({
-                'status': 'error',
-                'message': 'Identifiants incorrects'
-            }), 401
-        
-        # Créer une nouvelle session
-        token = generate_token()
-        sessions_db[token] = {
-            'username': username,
-            'expires_at': datetime.now() + timedelta(days=7)
-        }
-        
+    data = request.get_json(silent=True) or {}
+
+    if not LOGIN_FIELDS.issubset(data):
         return jsonify({
-            'status': 'success',
-            'message': 'Connexion réussie',
-            'user': {
-                'username': username,
-                'email': users_db[username]['email']
-            },
-            'token': token
-        }), 200
-        
-    except Exception as e:
+            'status': 'error',
+            'message': 'Identifiants manquants'
+        }), 400
+
+    username = data['username'].strip()
+    password = data['password']
+
+    # Vérifier les identifiants
+    if username not in users_db:
         return jsonify({
             'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+            'message': 'Identifiants incorrects'
+        }), 401
+
+    stored_hash = users_db[username]['password_hash']
+    if not verify_password(password, stored_hash):
+        return jsonify({
+            'status': 'error',
+            'message': 'Identifiants incorrects'
+        }), 401
+
+    # Mise à niveau opportuniste si les paramètres de coût ont changé
+    if ph.check_needs_rehash(stored_hash):
+        users_db[username]['password_hash'] = ph.hash(password)
+
+    # Créer une nouvelle session
+    token = generate_token()
+    expires_at = time.time() + 7 * 86400
+    with sessions_lock:
+        sessions_db[token] = {
+            'username': username,
+            'expires_at': expires_at
+        }
+        heapq.heappush(session_expiry_heap, (expires_at, token))
+        user_sessions[username].add(token)
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Connexion réussie',
+        'user': {
+            'username': username,
+            'email': users_db[username]['email']
+        },
+        'token': token
+    }), 200
 
 @app.route('/api/auth/logout', methods=['POST'])
 @require_auth
 def logout():
     """Déconnexion - supprime la session active"""
-    try:
-        auth_header = request.headers.get('Authorization')
-        token = auth_header.split(' ')[1]
-        
-        if token in sessions_db:
-            del sessions_db[token]
-        
-        return jsonify({
-            'status': 'success',
-            'message': 'Déconnexion réussie'
-        }), 200
-        
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+    auth_header = request.headers.get('Authorization')
+    token = (auth_header or '').partition(' ')[2]
+
+    with sessions_lock:
+        session = sessions_db.pop(token, None)
+        if session:
+            user_sessions[session['username']].discard(token)
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Déconnexion réussie'
+    }), 200
 
 @app.route('/api/auth/forgot-password', methods=['POST'])
+@limiter.limit('3 per hour')
 def forgot_password():
     """
     Demande de réinitialisation de mot de passe
     Body: { "email": "..." }
     """
-    try:
-        data = request.get_json()
-        
-        if 'email' not in data:
-            return jsonify({
-                'status': 'error',
-                'message': 'Email manquant'
-            }), 400
-        
-        email = data['email'].strip().lower()
-        
-        # Chercher l'utilisateur par email
-        user_found = None
-        for username, user_data in users_db.items():
-            if user_data['email'] == email:
-                user_found = username
-                break
-        
-        if not user_found:
-            # Ne pas révéler si l'email existe ou non (sécurité)
-            return jsonify({
-                'status': 'success',
-                'message': 'Si cet email existe, un code a été envoyé'
-            }), 200
-        
-        # Générer un code de réinitialisation
-        reset_code = generate_reset_code()
-        reset_codes_db[email] = {
-            'code': reset_code,
-            'username': user_found,
-            'expires_at': datetime.now() + timedelta(minutes=10)
-        }
-        
-        # EN PRODUCTION: Envoyer par email
-        print(f"📧 Code de réinitialisation pour {email}: {reset_code}")
-        
+    data = request.get_json(silent=True) or {}
+
+    if 'email' not in data:
+        return jsonify({
+            'status': 'error',
+            'message': 'Email manquant'
+        }), 400
+
+    email = data['email'].strip().lower()
+
+    # Chercher l'utilisateur par email (index O(1))
+    user_found = email_to_username.get(email)
+
+    if not user_found:
+        # Ne pas révéler si l'email existe ou non (sécurité)
         return jsonify({
             'status': 'success',
-            'message': 'Code de réinitialisation envoyé',
-            'debug_code': reset_code  # À SUPPRIMER EN PRODUCTION!
+            'message': 'Si cet email existe, un code a été envoyé'
         }), 200
-        
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+
+    # Générer un code de réinitialisation
+    reset_code = generate_reset_code()
+    reset_codes_db[email] = {
+        'code': reset_code,
+        'username': user_found,
+        'expires_at': time.time() + 600
+    }
+
+    # EN PRODUCTION: Envoyer par email
+    print(f"📧 Code de réinitialisation pour {email}: {reset_code}")
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Code de réinitialisation envoyé',
+        'debug_code': reset_code  # À SUPPRIMER EN PRODUCTION!
+    }), 200
 
 @app.route('/api/auth/verify-reset-code', methods=['POST'])
+@limiter.limit('5 per minute')
 def verify_reset_code():
     """
     Vérifie le code de réinitialisation
     Body: { "email": "...", "code": "..." }
     """
-    try:
-        data = request.get_json()
-        
-        if not all(k in data for k in ['email', 'code']):
-            return jsonify({
-                'status': 'error',
-                'message': 'Données manquantes'
-            }), 400
-        
-        email = data['email'].strip().lower()
-        code = data['code'].strip()
-        
-        if email not in reset_codes_db:
-            return jsonify({
-                'status': 'error',
-                'message': 'Code invalide ou expiré'
-            }), 400
-        
-        reset_data = reset_codes_db[email]
-        
-        if datetime.now() > reset_data['expires_at']:
-            del reset_codes_db[email]
-            return jsonify({
-                'status': 'error',
-                'message': 'Code expiré'
-            }), 400
-        
-        if reset_data['code'] != code:
-            return jsonify({
-                'status': 'error',
-                'message': 'Code incorrect'
-            }), 400
-        
+    data = request.get_json(silent=True) or {}
+
+    if not VERIFY_CODE_FIELDS.issubset(data):
         return jsonify({
-            'status': 'success',
-            'message': 'Code vérifié avec succès'
-        }), 200
-        
-    except Exception as e:
+            'status': 'error',
+            'message': 'Données manquantes'
+        }), 400
+
+    email = data['email'].strip().lower()
+    code = data['code'].strip()
+
+    if email not in reset_codes_db:
+        return jsonify({
+            'status': 'error',
+            'message': 'Code invalide ou expiré'
+        }), 400
+
+    reset_data = reset_codes_db[email]
+
+    if time.time() > reset_data['expires_at']:
+        del reset_codes_db[email]
+        return jsonify({
+            'status': 'error',
+            'message': 'Code expiré'
+        }), 400
+
+    # Comparaison en temps constant: un != ordinaire s'arrête au
+    # premier octet différent et laisse fuiter le préfixe correct.
+    # Sur des octets: compare_digest refuse les str non-ASCII, un code
+    # soumis avec des accents provoquait un 500 au lieu d'un 400
+    if not hmac.compare_digest(reset_data['code'].encode(),
+                               code.encode('utf-8')):
         return jsonify({
             'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+            'message': 'Code incorrect'
+        }), 400
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Code vérifié avec succès'
+    }), 200
 
 @app.route('/api/auth/reset-password', methods=['POST'])
+@limiter.limit('5 per minute')
 def reset_password():
     """
     Réinitialise le mot de passe
     Body: { "email": "...", "code": "...", "new_password": "..." }
     """
-    try:
-        data = request.get_json()
-        
-        if not all(k in data for k in ['email', 'code', 'new_password']):
-            return jsonify({
-                'status': 'error',
-                'message': 'Données manquantes'
-            }), 400
-        
-        email = data['email'].strip().lower()
-        code = data['code'].strip()
-        new_password = data['new_password']
-        
-        if len(new_password) < 6:
-            return jsonify({
-                'status': 'error',
-                'message': 'Mot de passe trop court'
-            }), 400
-        
-        if email not in reset_codes_db:
-            return jsonify({
-                'status': 'error',
-                'message': 'Code invalide ou expiré'
-            }), 400
-        
-        reset_data = reset_codes_db[email]
-        
-        if datetime.now() > reset_data['expires_at']:
-            del reset_codes_db[email]
-            return jsonify({
-                'status': 'error',
-                'message': 'Code expiré'
-            }), 400
-        
-        if reset_data['code'] != code:
-            return jsonify({
-                'status': 'error',
-                'message': 'Code incorrect'
-            }), 400
-        
-        # Mettre à jour le mot de passe
-        username = reset_data['username']
-        users_db[username]['password_hash'] = hash_password(new_password)
-        
-        # Supprimer le code et toutes les sessions
+    data = request.get_json(silent=True) or {}
+
+    if not RESET_FIELDS.issubset(data):
+        return jsonify({
+            'status': 'error',
+            'message': 'Données manquantes'
+        }), 400
+
+    email = data['email'].strip().lower()
+    code = data['code'].strip()
+    new_password = data['new_password']
+
+    if len(new_password) < 6:
+        return jsonify({
+            'status': 'error',
+            'message': 'Mot de passe trop court'
+        }), 400
+
+    if email not in reset_codes_db:
+        return jsonify({
+            'status': 'error',
+            'message': 'Code invalide ou expiré'
+        }), 400
+
+    reset_data = reset_codes_db[email]
+
+    if time.time() > reset_data['expires_at']:
         del reset_codes_db[email]
-        sessions_to_delete = [token for token, session in sessions_db.items() 
-                             if session['username'] == username]
-        for token in sessions_to_delete:
-            del sessions_db[token]
-        
         return jsonify({
-            'status': 'success',
-            'message': 'Mot de passe modifié avec succès'
-        }), 200
-        
-    except Exception as e:
+            'status': 'error',
+            'message': 'Code expiré'
+        }), 400
+
+    # Comparaison en temps constant: un != ordinaire s'arrête au
+    # premier octet différent et laisse fuiter le préfixe correct.
+    # Sur des octets: compare_digest refuse les str non-ASCII, un code
+    # soumis avec des accents provoquait un 500 au lieu d'un 400
+    if not hmac.compare_digest(reset_data['code'].encode(),
+                               code.encode('utf-8')):
         return jsonify({
             'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+            'message': 'Code incorrect'
+        }), 400
+
+    # Mettre à jour le mot de passe
+    username = reset_data['username']
+    users_db[username]['password_hash'] = hash_password(new_password)
+
+    # Supprimer le code et toutes les sessions de l'utilisateur
+    # (index inverse: pas de parcours de tout sessions_db)
+    del reset_codes_db[email]
+    with sessions_lock:
+        for token in user_sessions.pop(username, ()):
+            sessions_db.pop(token, None)
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Mot de passe modifié avec succès'
+    }), 200
 
 # ============================================
 # ROUTES CAPTEURS - TEMPS RÉEL UNIQUEMENT
 # ============================================
 
+def recompute_stats(username):
+    """Recalcule les agrégats depuis le tampon (borné à 100 lectures)"""
+    stats = _empty_stats()
+    for r in sensor_data_db[username]:
+        t, h = r['temperature'], r['humidity']
+        stats['n'] += 1
+        stats['t_sum'] += t
+        stats['t_min'] = min(stats['t_min'], t)
+        stats['t_max'] = max(stats['t_max'], t)
+        stats['h_sum'] += h
+        stats['h_min'] = min(stats['h_min'], h)
+        stats['h_max'] = max(stats['h_max'], h)
+    sensor_stats[username] = stats
+
+def record_reading(username, reading):
+    """
+    Ajoute une lecture au tampon et met à jour les agrégats courants de
+    façon incrémentale - recalcul complet seulement si la lecture
+    évincée portait un extrême (cas rare)
+    """
+    with sensor_lock:
+        buf = sensor_data_db[username]
+        evicted = buf[0] if len(buf) == MAX_READINGS else None
+        buf.append(reading)
+
+        stats = sensor_stats[username]
+        if evicted is not None and (
+                evicted['temperature'] <= stats['t_min']
+                or evicted['temperature'] >= stats['t_max']
+                or evicted['humidity'] <= stats['h_min']
+                or evicted['humidity'] >= stats['h_max']):
+            recompute_stats(username)
+            return
+
+        t, h = reading['temperature'], reading['humidity']
+        if evicted is not None:
+            stats['t_sum'] -= evicted['temperature']
+            stats['h_sum'] -= evicted['humidity']
+        else:
+            stats['n'] += 1
+        stats['t_sum'] += t
+        stats['h_sum'] += h
+        stats['t_min'] = min(stats['t_min'], t)
+        stats['t_max'] = max(stats['t_max'], t)
+        stats['h_min'] = min(stats['h_min'], h)
+        stats['h_max'] = max(stats['h_max'], h)
+
 @app.route('/api/sensors/data', methods=['POST'])
 @require_auth
 def receive_sensor_data():
@@ -433,58 +616,48 @@ def receive_sensor_data():
     Les données sont stockées en mémoire (effacées au redémarrage)
     Body: { "device_id": "...", "temperature": ..., "humidity": ... }
     """
-    try:
-        data = request.get_json()
-        username = request.current_user
-        
-        if not all(k in data for k in ['temperature', 'humidity']):
-            return jsonify({
-                'status': 'error',
-                'message': 'Données manquantes'
-            }), 400
-        
-        device_id = data.get('device_id', 'ESP32_DEFAULT')
-        temperature = float(data['temperature'])
-        humidity = float(data['humidity'])
-        
-        # Validation
-        if not (-40 <= temperature <= 80):
-            return jsonify({
-                'status': 'error',
-                'message': 'Température hors limites (-40 à 80°C)'
-            }), 400
-        
-        if not (0 <= humidity <= 100):
-            return jsonify({
-                'status': 'error',
-                'message': 'Humidité hors limites (0 à 100%)'
-            }), 400
-        
-        # Ajouter la lecture en mémoire
-        reading = {
-            'id': len(sensor_data_db[username]) + 1,
-            'device_id': device_id,
-            'temperature': temperature,
-            'humidity': humidity,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        # Garder seulement les 100 dernières lectures
-        sensor_data_db[username].append(reading)
-        if len(sensor_data_db[username]) > 100:
-            sensor_data_db[username] = sensor_data_db[username][-100:]
-        
+    data = request.get_json(silent=True) or {}
+    username = request.current_user
+
+    if not SENSOR_FIELDS.issubset(data):
         return jsonify({
-            'status': 'success',
-            'message': 'Données reçues',
-            'reading': reading
-        }), 201
-        
-    except Exception as e:
+            'status': 'error',
+            'message': 'Données manquantes'
+        }), 400
+
+    device_id = data.get('device_id', 'ESP32_DEFAULT')
+    temperature = float(data['temperature'])
+    humidity = float(data['humidity'])
+
+    # Validation en un seul test: isfinite rejette explicitement
+    # NaN/inf, qui empoisonneraient les agrégats incrémentaux
+    # (somme et min/max ne s'en remettent jamais)
+    if not (math.isfinite(temperature) and -40.0 <= temperature <= 80.0
+            and math.isfinite(humidity) and 0.0 <= humidity <= 100.0):
         return jsonify({
             'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+            'message': 'Valeurs hors limites (temp -40 à 80°C, '
+                       'humidité 0 à 100%)'
+        }), 400
+
+    # Ajouter la lecture en mémoire
+    reading = {
+        'id': next(reading_counters[username]),
+        'device_id': device_id,
+        'temperature': temperature,
+        'humidity': humidity,
+        'timestamp': datetime.now().isoformat()
+    }
+
+    # La deque bornée garde d'elle-même les 100 dernières lectures,
+    # et les agrégats de get_stats sont tenus à jour au passage
+    record_reading(username, reading)
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Données reçues',
+        'reading': reading
+    }), 201
 
 @app.route('/api/sensors/data', methods=['GET'])
 @require_auth
@@ -493,121 +666,119 @@ def get_sensor_data():
     Récupère les données temps réel stockées en mémoire
     Query params: limit
     """
-    try:
-        username = request.current_user
-        limit = request.args.get('limit', 100, type=int)
-        
-        data = sensor_data_db[username][-limit:]
-        
-        return jsonify({
-            'status': 'success',
-            'count': len(data),
-            'data': data
-        }), 200
-        
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+    username = request.current_user
+    limit = request.args.get('limit', 100, type=int)
+
+    buf = sensor_data_db[username]
+    # Cas courant (limit par défaut >= taille du tampon): copie directe,
+    # islice ne sert que quand il faut réellement tronquer
+    if limit >= len(buf):
+        data = list(buf)
+    else:
+        data = list(itertools.islice(buf, len(buf) - limit, None))
+
+    return jsonify({
+        'status': 'success',
+        'count': len(data),
+        'data': data
+    }), 200
 
 @app.route('/api/sensors/stats', methods=['GET'])
 @require_auth
 def get_stats():
-    """Calcule les statistiques des données en mémoire"""
-    try:
-        username = request.current_user
-        readings = sensor_data_db[username]
-        
-        if not readings:
-            return jsonify({
-                'status': 'success',
-                'statistics': {
-                    'total_readings': 0,
-                    'temperature': {'average': 0, 'minimum': 0, 'maximum': 0},
-                    'humidity': {'average': 0, 'minimum': 0, 'maximum': 0}
-                }
-            }), 200
-        
-        temps = [r['temperature'] for r in readings]
-        hums = [r['humidity'] for r in readings]
-        
+    """Lit les statistiques maintenues incrémentalement - O(1) par appel"""
+    username = request.current_user
+    stats = sensor_stats[username]
+    n = stats['n']
+
+    if n == 0:
         return jsonify({
             'status': 'success',
             'statistics': {
-                'total_readings': len(readings),
-                'temperature': {
-                    'average': round(sum(temps) / len(temps), 2),
-                    'minimum': round(min(temps), 2),
-                    'maximum': round(max(temps), 2)
-                },
-                'humidity': {
-                    'average': round(sum(hums) / len(hums), 2),
-                    'minimum': round(min(hums), 2),
-                    'maximum': round(max(hums), 2)
-                }
+                'total_readings': 0,
+                'temperature': {'average': 0, 'minimum': 0, 'maximum': 0},
+                'humidity': {'average': 0, 'minimum': 0, 'maximum': 0}
             }
         }), 200
-        
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+
+    return jsonify({
+        'status': 'success',
+        'statistics': {
+            'total_readings': n,
+            'temperature': {
+                'average': round(stats['t_sum'] / n, 2),
+                'minimum': round(stats['t_min'], 2),
+                'maximum': round(stats['t_max'], 2)
+            },
+            'humidity': {
+                'average': round(stats['h_sum'] / n, 2),
+                'minimum': round(stats['h_min'], 2),
+                'maximum': round(stats['h_max'], 2)
+            }
+        }
+    }), 200
 
 @app.route('/api/sensors/clear', methods=['DELETE'])
 @require_auth
 def clear_sensor_data():
     """Efface toutes les données capteurs de l'utilisateur"""
-    try:
-        username = request.current_user
-        sensor_data_db[username] = []
-        
-        return jsonify({
-            'status': 'success',
-            'message': 'Données effacées'
-        }), 200
-        
-    except Exception as e:
-        return jsonify({
-            'status': 'error',
-            'message': f'Erreur: {str(e)}'
-        }), 500
+    username = request.current_user
+    with sensor_lock:
+        sensor_data_db[username].clear()
+        sensor_stats[username] = _empty_stats()
+        reading_counters[username] = itertools.count(1)
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Données effacées'
+    }), 200
 
 # ============================================
 # ROUTE RACINE
 # ============================================
 
+# Le corps de la route racine est constant: sérialisé une fois à
+# l'import, renvoyé tel quel ensuite (pas de jsonify par requête)
+_HOME_BODY = app.json.dumps({
+    'project': 'SensorFlow Hub',
+    'version': '2.0 - Temps Réel',
+    'description': 'Plateforme IoT temps réel (sans base de données)',
+    'storage': 'En mémoire - données perdues au redémarrage',
+    'endpoints': {
+        'auth': {
+            'POST /api/auth/register': 'Inscription',
+            'POST /api/auth/login': 'Connexion',
+            'POST /api/auth/logout': 'Déconnexion',
+            'POST /api/auth/forgot-password': 'Demande code',
+            'POST /api/auth/verify-reset-code': 'Vérifier code',
+            'POST /api/auth/reset-password': 'Nouveau mot de passe'
+        },
+        'sensors': {
+            'POST /api/sensors/data': 'Envoyer données (temps réel)',
+            'GET /api/sensors/data': 'Récupérer données',
+            'GET /api/sensors/stats': 'Statistiques',
+            'DELETE /api/sensors/clear': 'Effacer données'
+        }
+    }
+}).encode('utf-8')
+
 @app.route('/')
 def home():
     """Informations sur l'API"""
-    return jsonify({
-        'project': 'SensorFlow Hub',
-        'version': '2.0 - Temps Réel',
-        'description': 'Plateforme IoT temps réel (sans base de données)',
-        'storage': 'En mémoire - données perdues au redémarrage',
-        'endpoints': {
-            'auth': {
-                'POST /api/auth/register': 'Inscription',
-                'POST /api/auth/login': 'Connexion',
-                'POST /api/auth/logout': 'Déconnexion',
-                'POST /api/auth/forgot-password': 'Demande code',
-                'POST /api/auth/verify-reset-code': 'Vérifier code',
-                'POST /api/auth/reset-password': 'Nouveau mot de passe'
-            },
-            'sensors': {
-                'POST /api/sensors/data': 'Envoyer données (temps réel)',
-                'GET /api/sensors/data': 'Récupérer données',
-                'GET /api/sensors/stats': 'Statistiques',
-                'DELETE /api/sensors/clear': 'Effacer données'
-            }
-        }
-    })
+    return Response(_HOME_BODY, mimetype='application/json')
 
 # ============================================
 # GESTION DES ERREURS
 # ============================================
 
+# Les handlers n'ont plus de try/except couverture: une exception
+# imprévue remonte ici au lieu de renvoyer str(e) au client (fuite
+# d'internals) et le chemin nominal s'exécute sans bloc d'exception
+@app.errorhandler(ValueError)
+def bad_value(error):
+    # float('abc') dans les routes capteurs, typiquement
+    return jsonify({'status': 'error', 'message': 'Valeur invalide'}), 400
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'status': 'error', 'message': 'Route non trouvée'}), 404
@@ -640,4 +811,10 @@ if __name__ == '__main__':
     print("   DELETE /api/sensors/clear")
     print("="*60 + "\n")
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Serveur de développement uniquement - en production:
+    # SENSORFLOW_BACKEND=memory gunicorn -w 1 --threads 8 wsgi:app
+    # Un seul worker obligatoirement: l'état (users_db,
+    # sessions_db, limiteur memory://) vit dans le processus, un
+    # token émis par un worker serait inconnu des autres
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
+    app.run(host='0.0.0.0', port=5000, debug=debug)
\ No newline at end of file
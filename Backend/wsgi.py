@@ -0,0 +1,47 @@
+"""
+SensorFlow Hub - Point d'entrée WSGI
+Expose l'application Flask pour un vrai serveur de production:
+    gunicorn -w 4 --threads 4 -b 0.0.0.0:5000 wsgi:app
+Le serveur de développement Werkzeug (app.run) traite les requêtes
+quasi séquentiellement et plafonne tout le backend.
+
+Choix du backend via SENSORFLOW_BACKEND:
+  - 'db' (défaut): API avec base SQLite (auth-app-integrated-db.py)
+  - 'memory': API temps réel en mémoire (auth_app.py)
+
+Attention: le backend 'memory' garde tout son état (utilisateurs,
+sessions, quotas du limiteur) dans le processus - le lancer avec
+-w 1 --threads N, plusieurs workers ne partageraient pas les sessions.
+Auteur: Roua Jendoubi
+Date: 2025
+"""
+
+import importlib.util
+import os
+import sys
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _here)
+
+if os.environ.get('SENSORFLOW_BACKEND', 'db') == 'memory':
+    from auth_app import app
+else:
+    # Le fichier principal contient des tirets dans son nom: chargement
+    # par chemin plutôt que par import classique
+    _spec = importlib.util.spec_from_file_location(
+        'sensorflow_backend',
+        os.path.join(_here, 'auth-app-integrated-db.py'))
+    _backend = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_backend)
+
+    app = _backend.app
+
+    # Même initialisation que le lancement direct en développement
+    _backend.init_db()
+    _backend.purge_expired()
+    _backend.fill_connection_pool()
+    _backend.start_purge_scheduler()
+    _backend.start_reading_flusher()
+
+# Alias attendu par certains serveurs WSGI (uwsgi, mod_wsgi)
+application = app